@@ -1,4 +1,4 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 
 # wad2image - convert Doom WAD files to images
 # Copyright (C)2017 Steven Elliott
@@ -18,64 +18,96 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA
 # 02110-1301, USA.
 
-from __future__ import print_function
-
 # Imports
 
 import argparse
 import bisect
-import filecmp
+import concurrent.futures
+import fnmatch
 import glob
+import hashlib
+import io
 import math
+import multiprocessing
 import os
 import PIL.Image
+import PIL.ImageChops
 import PIL.ImageColor
 import PIL.ImageDraw
 import PIL.ImageEnhance
 import random
 import re
+import struct
 import subprocess
 import sys
+import threading
+import time
 
 # Globals
 
 args          = {}    # Command line arguments.
+cache_lock    = threading.Lock() # Protects cache_writable.
+# Maximum size in bytes of the sprite cache.
+cache_max_size = 64 << 20
+cache_tmp_age = 3600  # Seconds to keep temporary files in the sprite cache.
+# False once writing to the sprite cache has failed.
+cache_writable = True
 iwad          = {}    # Main IWAD file.
 colors_names  = []    # Names of colors for colors diff images.
 colors_values = []    # Values of colors for colors diff images.
+comment_re    = re.compile("#.*") # Comments in the Yadex files.
 created_paths = set() # Paths created by this program, which are images.
 created_diffs = set() # Paths created to diffs. Subset of created_paths.
+desc_re       = re.compile("\"[^\"]*\"") # Descriptions in the Yadex files.
+frame_to_usi  = {}    # Frame to an RGBA sprite image, not scaled.
 frames        = []    # All frames in alphabetical order.
 inter_paths   = set() # Intermediate paths used to produce diff images.
-last_scale    = None  # Scale of the last map drawn.
 lt_prec       = []    # Precedence of line types.
 lt_to_color   = {}    # From the line type (secret, etc) to color and bang.
+map_match     = None  # Match function for map names from --map-pattern.
 map_nums      = set() # Map numbers to include.
 map_ranges    = []    # Map numbers ranges to include.
+map_to_hash   = {}    # From map name to a hash of the last image's pixels.
 map_to_ipath  = {}    # From map name to index, path used for saving.
 map_to_size   = {}    # From map name to size, scale, etc. image info.
+name_to_color = {}    # From color name and mode to color.
+pal_to_rgba   = {}    # From palette and transparent index to RGBA palette.
+# From a sprite name (four characters) to its first frame.
+prefix_to_frame = {}
+scale_jobs    = 1     # Number of threads used to scale sprites for a map.
+# Sector types, which are based on the "st"s in the Yadex files.
 st_names      = ["normal", "blinks", "2hz", "1hz", "20p_2_hz", "10P", "none_1",
                  "5p", "oscillates", "secret", "closes_30s", "20p_end", "1hz_syn",
                  "2hz_syn", "opens_300s", "none_2", "20p", "flicker"]
-st_to_num     = {}    # Table for the above, which is based on the "st"s in the Yadex files.
+st_to_num     = dict(zip(st_names, range(len(st_names)))) # Name to number.
 tt_to_color   = {}    # Thing type to color.
+tt_to_frame   = {}    # Thing type to the frame of its sprite in the IWAD.
 tt_to_info    = {}    # Thing type info from the Yadex files.
-tt_to_si      = {}    # Thing type to an image of the thing scaled for the map.
-tt_to_usi     = {}    # Thing type to an sprite image, not scaled.
+tt_to_si      = {}    # Thing type and scale, or frame and size, to a scaled
+                      # image, etc.
 third_dir     = None  # Third-party directory.
 
 # Functions
 
 # Add an index to a path. The index is before the extension.
 def add_index(path, index):
-    last_dot = path.rfind(".")
-    if last_dot == -1:
+    root, ext = os.path.splitext(path)
+    if not ext:
         # This seems odd. Just append the index at the end.
-        warn("Path \"%s\" does not contain \".\"" % path,
-              file=sys.stderr)
-        return "%s-%d" % (path, index)
-    else:
-        return "%s-%d%s" % (path[:last_dot], index, path[last_dot:])
+        warn("Path \"%s\" does not have an extension" % path)
+    return "%s-%d%s" % (root, index, ext)
+
+# Log the version of Pillow, and make sure it's Pillow-SIMD if required.
+# Pillow-SIMD is a build of Pillow that's faster at scaling and other things.
+# Its versions have a ".post" suffix.
+def check_pillow():
+    version = getattr(PIL, "__version__", None) or getattr(PIL,
+        "PILLOW_VERSION", "unknown")
+    is_simd = ".post" in version
+    verbose("Pillow version is %s%s." % (version, " (SIMD)" if is_simd else ""))
+    if args.require_simd and not is_simd:
+        fatal("Pillow-SIMD is required, but Pillow version %s is not \
+Pillow-SIMD." % version)
 
 # Create a colored image where each revision has it's own color. The revision
 # colors are used where there are image differences.
@@ -88,17 +120,10 @@ def create_colors_image(name, path, images):
     min_width  = min(image.size[0] for image in images)
     min_height  = min(image.size[1] for image in images)
 
-    bw_images = [image.convert("L") for image in images]
-    bw_pixels = [bw_image.load() for bw_image in bw_images]
-
-    # Pixels all on or all off.
-    all_on = [True] * icount
-    all_off = [False] * icount
-
     # Local copies for performance.
     thresh = args.colors_threshold
-    on_color = PIL.ImageColor.getcolor(args.colors_on_color, "RGB")
-    off_color = PIL.ImageColor.getcolor(args.colors_off_color, "RGB")
+    on_color = get_color(args.colors_on_color, "RGB")
+    off_color = get_color(args.colors_off_color, "RGB")
 
     # Scale the index into the the colors so that colors are taken throughout
     # --colors-color-list rather than the first few. This is only done if
@@ -116,8 +141,10 @@ def create_colors_image(name, path, images):
                 colors_values[cnum][0], colors_values[cnum][1],
                 colors_values[cnum][2],path_index))
 
-    image_out = PIL.Image.new("RGB", (min_width, min_height))
-    pixels_out = image_out.load()
+    # The goal of the following is to make sure that the colors used are
+    # evenly throughout the spectrum of colors provided by --colors-color-list.
+    icolors = [colors_values[int(iscale * inum + 0.5) % len(colors_values)]
+               for inum in range(icount)]
 
     is_bw = False
     if args.colors_images == "bw":
@@ -130,40 +157,108 @@ def create_colors_image(name, path, images):
         # different are overwritten with colors anyway.
         image = images[0] if args.colors_images == "first" else images[-1]
         converter = PIL.ImageEnhance.Color(image)
-        pixels = converter.enhance(args.colors_saturation).load()
-
-    for x in range(min_width):
-        for y in range(min_height):
-            ons = [bw_pixels[inum][x, y] >= thresh for inum in range(icount)]
-            if ons == all_on:
-                # All the pixels are off, a common fast case.
-                color = on_color if is_bw else pixels[x, y]
-            elif ons == all_off:
+        basis = converter.enhance(args.colors_saturation)
+
+    if icount <= 8:
+        # The fast case. Combine the images into a single "code" image where
+        # bit inum of each pixel is set if that pixel is on in image inum. The
+        # color of each pixel only depends on its code, so the colors can be
+        # looked up in tables by Pillow rather than pixel by pixel in Python.
+        # Note that ImageChops.add() produces an image the size of the
+        # smaller image. Each greyscale image is only needed for its bit, so
+        # it's converted here rather than keeping all of them in memory.
+        code_image = PIL.Image.new("L", (min_width, min_height), 0)
+        for inum, image in enumerate(images):
+            if image.mode != "L":
+                image = image.convert("L")
+            bit_table = [0] * thresh + [1 << inum] * (256 - thresh)
+            code_image = PIL.ImageChops.add(code_image, image.point(bit_table))
+
+        # Tables from code to each of the red, green and blue values.
+        all_on_code = (1 << icount) - 1
+        band_tables = ([], [], [])
+        for code in range(256):
+            color_array = [0, 0, 0] # color of the output pixel
+            for inum in range(icount):
+                if code & (1 << inum):
+                    for c in range(3):
+                        # If more than one color than xor. It's good keep the
+                        # colors simple for this reason.
+                        color_array[c] ^= icolors[inum][c]
+            if is_bw and code == all_on_code:
+                color_array = on_color
+            elif is_bw and code == 0:
+                color_array = off_color
+            for c in range(3):
+                band_tables[c].append(color_array[c])
+        image_out = PIL.Image.merge("RGB",
+            [code_image.point(band_table) for band_table in band_tables])
+
+        if not is_bw:
+            # Where the pixels are all on or all off use the basis image.
+            basis_table = [255 if code in (0, all_on_code) else 0
+                           for code in range(256)]
+            image_out.paste(basis.crop((0, 0, min_width, min_height)),
+                            (0, 0), code_image.point(basis_table))
+
+        image_out.save(path)
+        return path
+
+    # The slow case. There are too many images for the codes to fit in a byte,
+    # so examine each pixel.
+    bw_pixels = [(image if image.mode == "L" else image.convert("L")).load()
+                 for image in images]
+    if not is_bw:
+        pixels = basis.load()
+
+    # As in the fast case bit inum of each pixel's code is set if that pixel
+    # is on in image inum, but the codes are Python integers.
+    all_on_code = (1 << icount) - 1
+    bw_pixels_bits = [(bw_pixels[inum], 1 << inum) for inum in range(icount)]
+
+    # The colors of the output pixels are collected row by row and then
+    # stored in the output image all at once.
+    colors_out = []
+    append_color = colors_out.append
+
+    # From the code to the color when some pixels are on and some are not.
+    code_to_color = {}
+
+    for y in range(min_height):
+        for x in range(min_width):
+            code = 0
+            for bw_pixel, bit in bw_pixels_bits:
+                if bw_pixel[x, y] >= thresh:
+                    code |= bit
+            if code == all_on_code:
                 # All the pixels are on, a common fast case.
+                color = on_color if is_bw else pixels[x, y]
+            elif not code:
+                # All the pixels are off, a common fast case.
                 color = off_color if is_bw else pixels[x, y]
+            elif code in code_to_color:
+                # Some pixels on, some not, but this combination has been
+                # seen before.
+                color = code_to_color[code]
             else:
-                # Some pixels on, some not, a less common slower case.
-                on_seen = False
+                # Some pixels on, some not, a less common slower case. Visit
+                # each bit that's set, lowest first.
                 color_array = [0, 0, 0] # color of the output pixel
-                for inum in range(icount):
-                    on = ons[inum]
-                    if on:
-                        # The goal of the following is to make sure that the
-                        # colors used are evenly throughout the spectrum of
-                        # colors provided by --colors-color-list.
-                        icolor = colors_values[int(iscale * inum + 0.5) %
-                                               len(colors_values)]
-                        if on_seen:
-                            for c in range(3):
-                                # If more than one color than xor. It's good
-                                # keep the colors simple for this reason.
-                                color_array[c] ^= icolor[c]
-                        else:
-                            color_array = list(icolor[:])
-                        on_seen = True
+                bits = code
+                while bits:
+                    bit = bits & -bits
+                    icolor = icolors[bit.bit_length() - 1]
+                    for c in range(3):
+                        # If more than one color than xor. It's good keep the
+                        # colors simple for this reason.
+                        color_array[c] ^= icolor[c]
+                    bits ^= bit
                 color = tuple(color_array)
-            pixels_out[x, y] = color
+                code_to_color[code] = color
+            append_color(color)
 
+    image_out = PIL.Image.new("RGB", (min_width, min_height))
+    image_out.putdata(colors_out)
     image_out.save(path)
     return path
 
@@ -191,14 +286,15 @@ def create_diff_images():
     maps = [m for m in map_to_ipath.keys() if map_to_ipath[m][0] > 1]
     maps.sort()
 
+    # The images are loaded by threads since Pillow releases the GIL while
+    # decoding.
+    executor = concurrent.futures.ThreadPoolExecutor(
+        multiprocessing.cpu_count())
+
     for m in maps:
-        images = []
-        new_paths = []
         index, path = map_to_ipath[m]
-        for i in range(1, index + 1):
-            new_path = add_index(path, i)
-            images.append(PIL.Image.open(new_path))
-            new_paths.append(new_path)
+        new_paths = [add_index(path, i) for i in range(1, index + 1)]
+        images = list(executor.map(load_image, new_paths))
         diff_path = create_diff_image(m, path, images)
         created_paths.add(diff_path)
         created_diffs.add(diff_path)
@@ -216,25 +312,40 @@ def create_diff_images():
                 verbose("Due to diff image %s at \"%s\" removed \"%s\"." % (
                     m, diff_path, new_path))
 
-# Draw a map and save.
-def draw_map(wad, name, path, image_format):
-    global last_scale
+    executor.shutdown()
+
+# Draw a map. "size" is the size and other information for the image, or None
+# if this map has not been seen before, in which case it's determined. Return
+# the image encoded as image_format, a hash of the image's pixels (or None)
+# and the size. Other than caches no globals are modified so that this can be
+# called by worker processes.
+def draw_map(wad_map, name, size, image_format):
     global lt_prec
-    global tt_to_si
 
     # Boolean to speed things up in the normal case where neither flip nor
     # rotation is done.
     flip_or_rotation = args.flip or args.rotation
 
     # This editor is used in a read-only way.
-    edit = omg.MapEditor(wad.maps[name])
+    edit = omg.MapEditor(wad_map)
+
+    # The fields of the map's structs that are needed are extracted once into
+    # lists since omg's structs access attributes through a Python method.
 
-    if name in map_to_size:
+    # The vertexes and things in Doom space, flipped and rotated if requested.
+    vertexes = [(v.x, v.y) for v in edit.vertexes]
+    things = [(thing.x, thing.y) for thing in edit.things]
+    thing_types = [thing.type for thing in edit.things]
+    if flip_or_rotation:
+        vertexes = flip_and_rotate(vertexes)
+        things = flip_and_rotate(things)
+
+    if size:
         # A prior image has already been created. Use existing size and other
         # information so it lines up.
         scale, image_width, image_height, \
             pxmin, pxmax, pymin, pymax, \
-            vxmin, vxmax, vymin, vymax = map_to_size[name]
+            vxmin, vxmax, vymin, vymax = size
     else:
         # The first time this map has been seen. We need to determine the size
         # and other information.
@@ -242,16 +353,15 @@ def draw_map(wad, name, path, image_format):
         # The vx and xy prefixed variables are in Doom space.
         vxmin = vymin = 32767
         vxmax = vymax = -32768
-        for v in edit.vertexes:
-            if flip_or_rotation:
-                vx, vy = flip_and_rotate(v.x, v.y)
-            else:
-                vx, vy = v.x, v.y
+        for vx, vy in vertexes:
             vxmin = min(vxmin, vx)
             vxmax = max(vxmax, vx)
             vymin = min(vymin, vy)
             vymax = max(vymax, vy)
 
+        # Local copy for performance.
+        margin = args.margin
+
         # If a width or height is specified then use that to determine the scale.
         # If they are both specified then use the smaller scale so that the result
         # will fit into width x height. For either width or height specified the
@@ -270,12 +380,12 @@ def draw_map(wad, name, path, image_format):
             if args.width is not None:
                 dims += 1
                 image_width = args.width
-                pxspan = image_width - 2 * args.margin
+                pxspan = image_width - 2 * margin
                 scale_x = pxspan / float(vxmax - vxmin)
             if args.height is not None:
                 dims += 1
                 image_height = args.height
-                pyspan = image_height - 2 * args.margin
+                pyspan = image_height - 2 * margin
                 scale_y = pyspan / float(vymax - vymin)
             scale = min(scale_x, scale_y)
             if scale_x == scale:
@@ -287,15 +397,15 @@ def draw_map(wad, name, path, image_format):
             scale = args.scale
 
         # The px and py prefixed variables are in pixels.
-        pxmin = args.margin
-        pxmax = int(scale * (vxmax - vxmin) + 0.5) + args.margin
-        pymin = args.margin
-        pymax = int(scale * (vymax - vymin) + 0.5) + args.margin
+        pxmin = margin
+        pxmax = int(scale * (vxmax - vxmin) + 0.5) + margin
+        pymin = margin
+        pymax = int(scale * (vymax - vymin) + 0.5) + margin
 
         if image_width_tight is None:
-            image_width_tight = (pxmax - pxmin) + 2 * args.margin
+            image_width_tight = (pxmax - pxmin) + 2 * margin
         if image_height_tight is None:
-            image_height_tight = (pymax - pymin) + 2 * args.margin
+            image_height_tight = (pymax - pymin) + 2 * margin
 
         if dims == 2:
             # If both dimensions were specified then adjust so that the
@@ -319,16 +429,9 @@ def draw_map(wad, name, path, image_format):
         pymin += args.offset_y
         pymax += args.offset_y
 
-        map_to_size[name] = scale, image_width, image_height, \
-                            pxmin, pxmax, pymin, pymax, \
-                            vxmin, vxmax, vymin, vymax
-
-    # If this map is being drawn with a different scale then discard the
-    # scaled sprite images.
-    # TODO: Consider storing all scaled images by keying off of tt+scale to
-    # speed things up in exchange for consuming more memory.
-    if last_scale and last_scale != scale:
-        tt_to_si = {}
+        size = scale, image_width, image_height, \
+               pxmin, pxmax, pymin, pymax, \
+               vxmin, vxmax, vymin, vymax
 
     # "scale" applies to the entire image. "thing_scale" is additional thing
     # scaling on top of "scale". And "cicle_scale" is on top of "thing_scale".
@@ -347,101 +450,157 @@ def draw_map(wad, name, path, image_format):
             warn("Grid lines will not be parallel to Doom space axes due to " \
                  "arbitrary rotation of %g." % args.rotation)
 
-        # Draw vertical grid lines.
-        vxstart = args.grid_step * int((vxmin - pxmin / scale) /
-                                        args.grid_step - 1)
-        vxstop  = args.grid_step * int((vxmin + (image_width - pxmin) / scale) /
-                                        args.grid_step + 1)
-        for vx in range(vxstart, vxstop + 1, args.grid_step):
-            px = int(scale * (vx - vxmin) + 0.5) + pxmin
-            draw.line((px, 0, px, image_height - 1), fill=args.grid_color)
-
-        # Draw horizontal grid lines.
-        vystart = args.grid_step * int((vymin - pymin / scale) /
-                                        args.grid_step - 1)
-        vystop  = args.grid_step * int((vymin + (image_height - pymin) / scale) /
-                                        args.grid_step + 1)
-        for vy in range(vystart, vystop + 1, args.grid_step):
-            py = int(scale * (vy - vymin) + 0.5) + pymin
-            draw.line((0, py, image_width - 1, py), fill=args.grid_color)
-
-    # Convert the vertices to points (image locations).
-    points= []
-    for v in edit.vertexes:
-        # TODO: Avoid flipping / rotating vertexes more than once. It's
-        # probably not used much anyway.
-        if flip_or_rotation:
-            vx, vy = flip_and_rotate(v.x, v.y)
-        else:
-            vx, vy = v.x, v.y
-        points.append((int(scale * (vx - vxmin) + 0.5) + pxmin,
-                       int(scale * (vymax - vy) + 0.5) + pymin))
-
-    # When the key is a boolean False is before True, so this places the two
-    # sided linedefs first. This is done so that they can be overwritten by the
-    # more substantial linedefs that make up the perimeter of the map.
-    edit.linedefs.sort(key=lambda a: not a.two_sided)
-
-    first = True
-    for line in edit.linedefs:
-        if first:
-            # Before drawing the lines remove invalid line types based on the
-            # first linedef. This assumes that all the linedefs have the same
-            # attributes.
-            lt_prec_new = []
-            for lt in lt_prec:
-                # Assume already parsed sector type (type int) is valid.
-                if type(lt) == int or hasattr(line, lt) or lt == "sector_tag":
-                    lt_prec_new.append(lt)
-                else:
-                    warn("Line type \""  + lt + "\" is not a valid."
-                          "Ignoring.")
-            lt_prec = lt_prec_new
-            first = False
+        # Rather than drawing each grid line the grid color is pasted through
+        # a mask for the vertical lines and then through a mask for the
+        # horizontal lines. The masks are made by stretching a single row or
+        # column. The alpha of the grid color is the value of the masks so
+        # that, like drawing, the color is blended, and it's blended twice
+        # where lines cross.
+        grid_color = get_color(args.grid_color, "RGBA")
+        alpha = grid_color[3]
+
+        # Local copy for performance.
+        grid_step = args.grid_step
+
+        # Vertical grid lines. Lines outside of the image are ignored.
+        vxstart = grid_step * int((vxmin - pxmin / scale) / grid_step - 1)
+        vxstop  = grid_step * int((vxmin + (image_width - pxmin) / scale) /
+                                   grid_step + 1)
+        pxs = set([int(scale * (vx - vxmin) + 0.5) + pxmin
+                   for vx in range(vxstart, vxstop + 1, grid_step)])
+        row = [alpha if px in pxs else 0 for px in range(image_width)]
+
+        # Horizontal grid lines.
+        vystart = grid_step * int((vymin - pymin / scale) / grid_step - 1)
+        vystop  = grid_step * int((vymin + (image_height - pymin) / scale) /
+                                   grid_step + 1)
+        pys = set([int(scale * (vy - vymin) + 0.5) + pymin
+                   for vy in range(vystart, vystop + 1, grid_step)])
+        column = [alpha if py in pys else 0 for py in range(image_height)]
+
+        image_size = (image_width, image_height)
+        row_image = PIL.Image.new("L", (image_width, 1))
+        row_image.putdata(row)
+        column_image = PIL.Image.new("L", (1, image_height))
+        column_image.putdata(column)
+        for line_image in (row_image, column_image):
+            im.paste(grid_color[:3], (0, 0) + image_size,
+                     line_image.resize(image_size, PIL.Image.NEAREST))
+
+    # Convert the vertices and things to points (image locations).
+    points = [(int(scale * (vx - vxmin) + 0.5) + pxmin,
+               int(scale * (vymax - vy) + 0.5) + pymin)
+              for vx, vy in vertexes]
+    thing_points = [(int(scale * (tx - vxmin) + 0.5) + pxmin,
+                     int(scale * (vymax - ty) + 0.5) + pymin)
+                    for tx, ty in things]
+
+    # The linedefs along with the fields needed. When the key is a boolean
+    # False is before True, so this places the two sided linedefs first. This
+    # is done so that they can be overwritten by the more substantial linedefs
+    # that make up the perimeter of the map.
+    linedefs = [(line.two_sided, line.vx_a, line.vx_b, line.front, line.back,
+                 line) for line in edit.linedefs]
+    linedefs.sort(key=lambda a: not a[0])
 
-        p1x, p1y = points[line.vx_a]
-        p2x, p2y = points[line.vx_b]
-
-        color = args.line_default_color
-        bang = False
-        done = False
+    # Local copies for performance.
+    line_default_color = args.line_default_color
+    thickness = args.thickness
+    thickness_bang = args.thickness_bang
+
+    if linedefs:
+        # Before drawing the lines remove invalid line types based on the
+        # first linedef. This assumes that all the linedefs have the same
+        # attributes.
+        line = linedefs[0][-1]
+        lt_prec_new = []
         for lt in lt_prec:
-            if type(lt) == int or lt == "sector_tag":
-                # Map from the front and back sidedefs to sectors.
-                sectors = [edit.sectors[edit.sidedefs[sd_id].sector]
-                           for sd_id in (line.front, line.back)
-                           if sd_id != -1]
-                for sector in sectors:
-                    if sector.type == lt or (lt == "sector_tag" and sector.tag):
-                        color, bang = lt_to_color[lt]
-                        done = True
-                        break
-                if done:
-                    break
-            elif getattr(line, lt) and not done:
-                color, bang = lt_to_color[lt]
+            # Assume already parsed sector type (type int) is valid.
+            if type(lt) == int or hasattr(line, lt) or lt == "sector_tag":
+                lt_prec_new.append(lt)
+            else:
+                warn("Line type \""  + lt + "\" is not a valid."
+                      "Ignoring.")
+        lt_prec = lt_prec_new
+
+    # The line types are identified by their precedence, which is their index
+    # in lt_prec. The lowest precedence found for a line determines its
+    # color. Precedence len(lt_prec) is for lines without a line type.
+    prec_to_color = [lt_to_color[lt] for lt in lt_prec]
+    prec_to_color.append((line_default_color, False))
+
+    # Line types that are line attributes (action, two_sided, etc.).
+    attr_precs = [(prec, lt) for prec, lt in enumerate(lt_prec)
+                  if not (type(lt) == int or lt == "sector_tag")]
+
+    # Line types that come from sectors only depend on the sector, so
+    # determine the lowest precedence for each sector once.
+    sector_precs = []
+    for sector in edit.sectors:
+        sector_type = sector.type
+        sector_tag = sector.tag
+        sector_prec = len(lt_prec)
+        for prec, lt in enumerate(lt_prec):
+            if (type(lt) == int or lt == "sector_tag") and (sector_type == lt or
+                    (lt == "sector_tag" and sector_tag)):
+                sector_prec = prec
+                break
+        sector_precs.append(sector_prec)
+
+    # And the same for each sidedef based on its sector.
+    sidedef_precs = [sector_precs[sidedef.sector] for sidedef in edit.sidedefs]
+
+    # Lines are collected into runs of connected lines with the same color and
+    # thickness. Each run is a polyline that can be drawn with a single call.
+    runs = []
+    for two_sided, vx_a, vx_b, front, back, line in linedefs:
+        # Map from the front and back sidedefs to sectors.
+        line_prec = len(lt_prec)
+        for sd_id in (front, back):
+            if sd_id != -1:
+                line_prec = min(line_prec, sidedef_precs[sd_id])
+        for prec, lt in attr_precs:
+            if prec >= line_prec:
+                break
+            if getattr(line, lt):
+                line_prec = prec
                 break
-        th = args.thickness_bang if bang else args.thickness
+        color, bang = prec_to_color[line_prec]
+        th = thickness_bang if bang else thickness
+
+        p1 = points[vx_a]
+        p2 = points[vx_b]
+        if runs and runs[-1][0] == color and runs[-1][1] == th and \
+                runs[-1][2][-1] == p1:
+            # This line continues the prior run.
+            runs[-1][2].append(p2)
+        else:
+            runs.append((color, th, [p1, p2]))
 
+    draw_ellipse = draw.ellipse
+    draw_line = draw.line
+    for color, th, run_points in runs:
         if th == 1:
-            draw.line((p1x, p1y, p2x, p2y), fill=color)
+            draw_line(run_points, fill=color)
         else:
             if th >= 3:
-                # Draw filled circles at either end of the line so that angled
+                # Draw filled circles at the ends of the lines so that angled
                 # lines fit together without gaps. The -2 and 0.5 was found by
                 # trial and error.
                 r = (th - 2) / 2.0 # radius
-                draw.ellipse((p1x - r + 0.5, p1y - r + 0.5,
-                              p1x + r + 0.5, p1y + r + 0.5), fill=color)
-                draw.ellipse((p2x - r + 0.5, p2y - r + 0.5,
-                              p2x + r + 0.5, p2y + r + 0.5), fill=color)
-            draw.line((p1x, p1y, p2x, p2y), fill=color, width=th)
+                for px, py in run_points:
+                    draw_ellipse((px - r + 0.5, py - r + 0.5,
+                                  px + r + 0.5, py + r + 0.5), fill=color)
+            draw_line(run_points, fill=color, width=th)
 
     do_sprite = "sprite" in args.thing_type
     do_circle = args.thing_type in ("circle", "sprite-and-circle")
     sprite_or_circle = args.thing_type == "sprite-or-circle"
     circle_type = "outline" if args.circle_outline else "fill"
 
+    if do_sprite and scale_jobs > 1:
+        scale_sprites(thing_types, scale)
+
     # Circle scaling is on top of thing scaling which is on top of overall
     # scaling.
     circle_scale = args.circle_scale * args.thing_scale * scale
@@ -453,81 +612,73 @@ def draw_map(wad, name, path, image_format):
     else:
         use_sprite_r = True
 
-    for thing in edit.things:
-        if flip_or_rotation:
-            tx, ty = flip_and_rotate(thing.x, thing.y)
-        else:
-            tx, ty = thing.x, thing.y
-        px = int(scale * (tx - vxmin) + 0.5) + pxmin
-        py = int(scale * (vymax - ty) + 0.5) + pymin
-        ti = get_thing_image(thing.type, scale) if do_sprite else None
-        if ti:
+    # Local copies for performance. The spectre color is parsed once here
+    # rather than by each paste.
+    im_paste = im.paste
+    spectre_color = get_color(args.spectre_color, im.mode)
+
+    # From thing type to what to paste for the things of that type on this
+    # map, which is the source, the mask, and half of the width and height.
+    # The source is a color for spectres (transparent things).
+    tt_to_paste = {}
+
+    for thing_type, (px, py) in zip(thing_types, thing_points):
+        paste_info = None
+        if do_sprite:
+            if thing_type not in tt_to_paste:
+                thing_image = get_thing_image(thing_type, scale)
+                if thing_image:
+                    ti, half_width, half_height = thing_image
+                    transparent = "s" in tt_to_info[thing_type][0]
+                    tt_to_paste[thing_type] = (
+                        spectre_color if transparent else ti, ti, half_width,
+                        half_height)
+                else:
+                    tt_to_paste[thing_type] = None
+            paste_info = tt_to_paste[thing_type]
+        if paste_info:
             # A scaled sprite image was found. Render it first.
-            transparent = "s" in tt_to_info[thing.type][0]
-            im.paste(args.spectre_color if transparent else ti,
-                     (px - int(ti.size[0] / 2 + 0.5),
-                      py - int(ti.size[1] / 2 + 0.5)), ti)
-        if  do_circle or (sprite_or_circle and not ti):
+            source, mask, half_width, half_height = paste_info
+            im_paste(source, (px - half_width, py - half_height), mask)
+        if  do_circle or (sprite_or_circle and not paste_info):
             # A circle is to be drawn.
             if use_sprite_r:
-                if thing.type in tt_to_info:
-                    cr = tt_to_info[thing.type][1]
+                if thing_type in tt_to_info:
+                    cr = tt_to_info[thing_type][1]
                 else:
                     warn("MAP %s unknown thing type %d at pixel (%d, %d)." % (
-                        name, thing.type, px, py))
+                        name, thing_type, px, py))
                     # TDOD: Some other size?
                     cr = 10
                 cr *= circle_scale
-            kwargs = {circle_type: get_circle_color(thing.type)}
-            draw.ellipse((px - cr, py - cr, px + cr, py + cr), **kwargs)
+            kwargs = {circle_type: get_circle_color(thing_type)}
+            draw_ellipse((px - cr, py - cr, px + cr, py + cr), **kwargs)
 
     # TODO: Does this help much?
     del draw
 
-    if args.dup_images != "overwrite" and name in map_to_ipath:
-        index = map_to_ipath[name][0]
-        old_path = add_index(path, index)
-        if index == 1:
-            # The first file was created without an index, but now it needs
-            # one since there will be more than one file.
-            rename_file(path, old_path)
-            verbose("Renamed map %s image \"%s\" to \"%s\"." % (
-                name, path, old_path))
-        index += 1
-        new_path = add_index(path, index)
-    else:
-        # Either the first time, or overwrite (same file used for all
-        # duplicates of the the same map). Use the path without an index
-        # added.
-        old_path = None
-        index = 1
-        new_path = path
+    # A hash of the pixels is used to detect identical images without having
+    # to save and compare files.
+    check_identical = args.dup_images != "overwrite" and (
+        not args.keep_identical_images)
+    im_hash = hashlib.sha256(im.tobytes()).digest() if check_identical \
+        else None
+
+    # Encode the image here so that it can be done by worker processes. A
+    # worker process can't exit on behalf of this process, so the error, if
+    # any, is returned for the caller to handle.
+    image_data = io.BytesIO()
     try:
-        im.save(new_path, image_format)
-        created_paths.add(new_path)
+        im.save(image_data, image_format)
     except Exception as err:
-        fatal("Unable to save map %s to \"%s\": %s." % (name, new_path, err))
-    if old_path and (not args.keep_identical_images) and filecmp.cmp(
-            old_path, new_path, shallow=False):
-        # Remove this duplicate image. Also, don't store the index so it's as
-        # if it never happened.
-        verbose("Discarded map %s identical image \"%s\"" % (name, new_path))
-        remove_file(new_path)
-        if index == 2:
-            # Undo the rename since we don't need an index suffix yet.
-            rename_file(old_path, path)
-            verbose("Renamed map %s image \"%s\" to \"%s\"." % (
-                name, old_path, path))
-    else:
-        # Store the index to keep track of what was created.
-        verbose("Drew map %s to \"%s\"." % (name, new_path))
-        map_to_ipath[name] = index, path
-
-    # Keep track of the last scale used.
-    last_scale = scale
+        return None, None, size, "Unable to save map %s as %s: %s." % (
+            name, image_format, err)
+    return image_data.getvalue(), im_hash, size, None
 
 # Draw maps matching the pattern and number specified.
 def draw_maps():
+    global scale_jobs
+
     # Make sure that the output directory exists.
     out_dir = expand_path(args.out_dir)
     if not os.path.exists(out_dir):
@@ -538,29 +689,71 @@ def draw_maps():
                 out_dir, err))
         verbose("Created output directory \"%s\"." % out_dir)
 
-    for wad_patts in args.wads:
-        wad = find_open_wad("WAD", wad_patts, True)
-        if not wad:
-            continue
-        for name in wad.maps.find(args.map_pattern):
-            if args.map_numbers:
-                # Match by number. If a map is all characters it matches 0.
-                found = False
-                num = str_to_num(name, 0)
-                if num in map_nums:
-                    found = True
-                if not found:
-                    for map_range in map_ranges:
-                        if num >= map_range[0] and num <= map_range[1]:
-                            found = True
-                            break
-                if not found:
-                    continue
-
-            # Use lower case for image names.
-            image_bname = (name + "." + args.format).lower()
-            image_path = path_join(out_dir, image_bname)
-            draw_map(wad, name, image_path, args.format)
+    # Only load all of the WADs at once if the maps are to be drawn by worker
+    # processes. Otherwise each WAD is loaded as its maps are drawn so that
+    # only one WAD is in memory at a time.
+    maps = find_maps(out_dir)
+    executor = None
+    jobs = args.jobs or multiprocessing.cpu_count()
+    if jobs > 1:
+        # Worker processes are forked so that they have the same state
+        # (arguments, IWAD, etc.) as this process.
+        if "fork" in multiprocessing.get_all_start_methods():
+            maps = list(maps)
+            if len(maps) > 1:
+                executor = concurrent.futures.ProcessPoolExecutor(jobs,
+                    multiprocessing.get_context("fork"))
+        else:
+            warn("Maps can not be drawn in parallel on this platform.")
+
+    if not executor:
+        # The maps are drawn one at a time, so use the jobs to scale the
+        # sprites for each map instead. Since the maps are drawn in order the
+        # size of each map is known by the time a later image of it is drawn.
+        scale_jobs = jobs
+        for wad_map, name, image_path in maps:
+            image_data, im_hash, size, err = draw_map(wad_map, name,
+                map_to_size.get(name), args.format)
+            if err:
+                fatal(err)
+            map_to_size[name] = size
+            save_map(name, image_path, image_data, im_hash)
+    else:
+        # The first time a map is seen the size of its image is determined.
+        # Later images of the same map have the same size so that they line
+        # up, so they are drawn after all of the first images.
+        firsts = []
+        laters = []
+        seen = set()
+        for i, (wad_map, name, image_path) in enumerate(maps):
+            if name in seen:
+                laters.append(i)
+            else:
+                firsts.append(i)
+                seen.add(name)
+
+        # Each image is saved as soon as it's drawn. The images of a map are
+        # still saved in the order the WADs were specified, which is all that
+        # matters for handling duplicates, since the first image of each map
+        # is in firsts and the rest are in laters in order. The worker
+        # processes are shut down even if this process exits early due to an
+        # error.
+        try:
+            for indexes in (firsts, laters):
+                wad_maps = [maps[i][0] for i in indexes]
+                names = [maps[i][1] for i in indexes]
+                sizes = [map_to_size.get(name) for name in names]
+                formats = [args.format] * len(indexes)
+                for i, (image_data, im_hash, size, err) in zip(indexes,
+                        executor.map(draw_map, wad_maps, names, sizes,
+                        formats)):
+                    if err:
+                        fatal(err)
+                    wad_map, name, image_path = maps[i] # @UnusedVariable
+                    map_to_size[name] = size
+                    save_map(name, image_path, image_data, im_hash)
+        finally:
+            executor.shutdown()
 
     if not len(created_paths):
         warn("No images were created. Check WADs and matching criteria (-n and -p).")
@@ -607,7 +800,6 @@ def find_file(context, spath, patterns, required):
     tdirs = find_dir(context, spath, True, False) # dirs to be tested.
     for tdir in tdirs:
         for patt in patts:
-            patt = patt.strip()
             # Determine the fully qualified pattern.
             fqpatt = path_join(tdir, patt)
             paths = glob.glob(fqpatt)
@@ -626,6 +818,36 @@ def find_file(context, spath, patterns, required):
               "\"%s\"." % (context, spath, patterns))
     return None
 
+# Find the maps in the WADs that match the pattern and numbers specified. Each
+# is yielded as the map, name and image path. The WADs are loaded as needed so
+# that each WAD can be released once its maps have been drawn.
+def find_maps(out_dir):
+    for wad_patts in args.wads:
+        wad = find_open_wad("WAD", wad_patts, True)
+        if not wad:
+            continue
+        for name in wad.maps:
+            if not map_match(name):
+                continue
+            if args.map_numbers:
+                # Match by number. If a map is all characters it matches 0.
+                found = False
+                num = str_to_num(name, 0)
+                if num in map_nums:
+                    found = True
+                if not found:
+                    for map_range in map_ranges:
+                        if num >= map_range[0] and num <= map_range[1]:
+                            found = True
+                            break
+                if not found:
+                    continue
+
+            # Use lower case for image names.
+            image_bname = (name + "." + args.format).lower()
+            image_path = path_join(out_dir, image_bname)
+            yield wad.maps[name], name, image_path
+
 # Open the IWAD file.
 def find_open_iwad():
     global frames
@@ -644,6 +866,8 @@ def find_open_iwad():
 things.")
         else:
             frames = sorted(sprites.keys())
+            for frame in frames:
+                prefix_to_frame.setdefault(frame[:4], frame)
     else:
         warn("No IWAD. Circles may be used to represent things.")
 
@@ -663,45 +887,46 @@ def find_open_wad(context, patterns, required):
     else:
         return None
 
-# Flip and rotate a point.
-def flip_and_rotate(x, y):
+# Flip and rotate a list of points, each of which is an (x, y) tuple. The
+# transformation is determined once and then applied to all the points.
+def flip_and_rotate(points):
     flip = args.flip
     rotation = args.rotation % 360.0
 
     if flip:
         # Mirror about the vertical axis.
-        x = -x
+        points = [(-x, y) for x, y in points]
 
-    # For rotation optimize by handling the easy 90 degree cases first.
+    # For rotation optimize by handling the easy 90 degree cases first. They
+    # only swap and negate, so integral points stay that way.
     if rotation == 0.0:
-        pass
+        return points
     elif rotation == 90.0:
-        x, y = y, -x
+        return [(y, -x) for x, y in points]
     elif rotation == 180.0:
-        x, y = -x, -y
+        return [(-x, -y) for x, y in points]
     elif rotation == 270.0:
-        x, y = -y, x
-    else:
-        # An arbitrary amount. This is the slow and unusual case. First
-        # convert to radians where rotation is counter clockwise.
-        rad = -rotation * (math.pi / 180.0)
-        rcos, rsin = math.cos(rad), math.sin(rad)
-        x, y = x * rcos - y * rsin, y * rcos + x * rsin
+        return [(-y, x) for x, y in points]
 
-    return x, y
+    # An arbitrary amount. This is the slow and unusual case. First convert to
+    # radians where rotation is counter clockwise.
+    rad = -rotation * (math.pi / 180.0)
+    rcos, rsin = math.cos(rad), math.sin(rad)
+    return [(x * rcos - y * rsin, y * rcos + x * rsin) for x, y in points]
 
 # Get a random but consistent color for a circle if no --circle-color.
 def get_circle_color(thing_type):
     # If a thing color was specified then use that for all things.
     if args.circle_color != "random":
-        color = list(PIL.ImageColor.getcolor(args.circle_color, "RGBA"))
+        color = list(get_color(args.circle_color, "RGBA"))
         color[3] = args.circle_alpha
         return tuple(color)
 
     if not thing_type in tt_to_color:
         # The seed is really just a means of getting a deterministic sequence
-        # of colors for each thing type.
-        random.seed((args.random_seed << 16) + thing_type)
+        # of colors for each thing type. A generator of its own is used so
+        # that the global one is not reseeded.
+        rand = random.Random((args.random_seed << 16) + thing_type)
 
         while True:
             # TDDO: Make sure it does not conflict with existing colors by
@@ -710,20 +935,33 @@ def get_circle_color(thing_type):
             # found for the same type regardless of the order the maps are
             # processed. For now just make sure it's not too close to black
             # or white.
-            color = (random.randint(0, 255), random.randint(0, 255),
-                     random.randint(0, 255), args.circle_alpha)
+            color = (rand.randint(0, 255), rand.randint(0, 255),
+                     rand.randint(0, 255), args.circle_alpha)
             csum = sum(color[:-1])
             if csum >= 128 and csum <= (3 * 255 - 128):
                 break
         tt_to_color[thing_type] = color
     return tt_to_color[thing_type]
 
+# Get the color for a color name (names or #RRGGBB) in the given mode. Colors
+# are only parsed the first time they're seen.
+def get_color(color_name, mode):
+    key = (color_name, mode)
+    if not key in name_to_color:
+        name_to_color[key] = PIL.ImageColor.getcolor(color_name, mode)
+    return name_to_color[key]
+
 # Get the first frame with given prefix (sprite).
 def get_frame(sprite):
     # Exit if the IWAD does not have any sprites.
     if not len(frames):
         return None
 
+    # The common case where the sprite is just a name, in which case the
+    # result of the search below is known.
+    if len(sprite) == 4 and sprite in prefix_to_frame:
+        return prefix_to_frame[sprite]
+
     i = bisect.bisect_left(frames, sprite)
 
     if i >= len(frames):
@@ -740,57 +978,112 @@ def get_frame(sprite):
 
 # Return the GIF version of a path.
 def get_gif_path(path):
-    last_dot = path.rfind(".")
-    if last_dot == -1:
-        # This seems odd. Just append the index at the end.
-        warn("For GIF path \"%s\" does not contain \".\"" % path)
-        return "%s.gif" % path
-    else:
-        return "%s.gif" % path[:last_dot]
+    root, ext = os.path.splitext(path)
+    if not ext:
+        # This seems odd. Just append the extension at the end.
+        warn("For GIF path \"%s\" does not have an extension" % path)
+    return "%s.gif" % root
+
+# Get the path in the sprite cache for a sprite scaled to a size, or None if
+# there is no cache. The name is based on the content of the sprite so that it
+# does not matter which IWAD or thing type it's for.
+def get_sprite_cache_path(sprite, width, height):
+    if not args.cache_dir:
+        return None
+    data = sprite.data + sprite.palette.save_bytes
+    try:
+        # The hash is only a name, so it's ok for Pythons in FIPS mode, which
+        # otherwise don't allow md5.
+        digest = hashlib.md5(data, usedforsecurity=False).hexdigest()
+    except TypeError:
+        # Python before 3.9.
+        digest = hashlib.md5(data).hexdigest()
+    return path_join(args.cache_dir, "%s-%dx%d-%s.png" % (digest, width, height,
+                                                        args.resample))
+
+# Get the frame of the sprite in the IWAD for a thing type, if possible.
+# Different thing types may have the same frame.
+def get_thing_frame(thing_type):
+    if thing_type in tt_to_frame:
+        return tt_to_frame[thing_type]
+
+    frame = None
+    if iwad and thing_type in tt_to_info:
+        frame = get_frame(tt_to_info[thing_type][2])
+
+    # Note that frame may be None, which is ok - don't try to get it again.
+    tt_to_frame[thing_type] = frame
+    return frame
 
-# Get the scaled image for a thing type, if possible.
+# Get the scaled image for a thing type, if possible. The image is returned
+# along with half of its width and height, which are used to center it.
 def get_thing_image(thing_type, scale):
-    if thing_type in tt_to_si:
+    key = (thing_type, scale)
+    if key in tt_to_si:
         # We already have it at the correct scale.
-        return tt_to_si[thing_type]
-
-    if thing_type in tt_to_usi:
-        # We already have it, but it needs to be scaled for this map.
-        unscaled_image = tt_to_usi[thing_type]
-    elif iwad and thing_type in tt_to_info:
-        unscaled_image = None
-        sprite = tt_to_info[thing_type][2]
-        # Get the frame for the sprite.
-        frame = get_frame(sprite)
-        if frame:
-            unscaled_image = iwad.sprites[frame].to_Image()
-            if unscaled_image:
-                # Index 247 has special meaning to Doom engines. It's the
-                # transparent color. The color at this index in the palette is
-                # irrelevant. Note that this does not work with older Pillow
-                # (ver 2.2.1 at least). So the images will be solid squares in
-                # that case.
-                unscaled_image.info["transparency"] = 247
-        tt_to_usi[thing_type] = unscaled_image
-    else:
-        unscaled_image = None
-        tt_to_usi[thing_type] = unscaled_image
+        return tt_to_si[key]
+
+    frame = get_thing_frame(thing_type)
+
+    thing_image = None
+    if frame:
+        sprite = iwad.sprites[frame]
 
-    scaled_image = None
-    if unscaled_image:
         # Thing scaling is on top of overall scaling.
         thing_scale = args.thing_scale * scale
 
-        new_width = int(thing_scale * unscaled_image.size[0] + 0.5)
-        new_height = int(thing_scale * unscaled_image.size[1] + 0.5)
-        if new_width and new_height:
-            scaled_image = unscaled_image.convert("RGBA").resize(
-                (new_width, new_height), PIL.Image.ANTIALIAS)
-
-    # Store to next time. This changes per map if the scale changes. Note that
-    # scaled_image may be None, which is ok - don't try to get it again.
-    tt_to_si[thing_type] = scaled_image
-    return scaled_image
+        # The size is in the sprite's header, so it's known without decoding
+        # the sprite.
+        width, height = sprite.dimensions
+        new_width = int(thing_scale * width + 0.5)
+        new_height = int(thing_scale * height + 0.5)
+        # Scaled sprites are shared by thing types with the same frame.
+        size_key = (frame, new_width, new_height)
+        scaled_image = None
+        if size_key in tt_to_si:
+            # Already scaled to this size for a different scale, or for
+            # another thing type with the same frame.
+            thing_image = tt_to_si[size_key]
+        elif not new_width or not new_height:
+            # At least one dimension rounds to zero, so there's nothing to
+            # draw.
+            pass
+        elif (new_width, new_height) == (width, height):
+            # Not scaled at all, so the unscaled image is used as is rather
+            # than being resized or cached.
+            scaled_image = get_unscaled_image(frame, sprite)
+        else:
+            cache_path = get_sprite_cache_path(sprite, new_width, new_height)
+            scaled_image = read_sprite_cache(cache_path)
+            if not scaled_image:
+                # Newer Pillow has the filters in Image.Resampling, and the
+                # old names such as ANTIALIAS have been removed.
+                filters = getattr(PIL.Image, "Resampling", PIL.Image)
+                scaled_image = get_unscaled_image(frame, sprite).resize(
+                    (new_width, new_height),
+                    getattr(filters, args.resample.upper()))
+                write_sprite_cache(cache_path, scaled_image)
+
+        if scaled_image:
+            thing_image = (scaled_image, int(scaled_image.size[0] / 2 + 0.5),
+                           int(scaled_image.size[1] / 2 + 0.5))
+            tt_to_si[size_key] = thing_image
+
+    # Store for next time. Images with other scales are kept for maps drawn
+    # with those scales. Note that thing_image may be None, which is ok -
+    # don't try to get it again.
+    tt_to_si[key] = thing_image
+    return thing_image
+
+# Get the RGBA image for the sprite of a frame, not scaled.
+def get_unscaled_image(frame, sprite):
+    if frame in frame_to_usi:
+        return frame_to_usi[frame]
+
+    # Convert once here rather than each time it's scaled.
+    unscaled_image = sprite_to_image(sprite)
+    frame_to_usi[frame] = unscaled_image
+    return unscaled_image
 
 # Initialize. Create the temporary directory and other things.
 def init():
@@ -818,10 +1111,6 @@ def init():
         fatal("Top level directory \"" + top_dir + "\" does not contain " +
               "expected subdirectory \"third-party\".")
 
-    # From sector type name to type number.
-    for i in range(len(st_names)):
-        st_to_num[st_names[i]] = i
-
 # A helper for argparse that enforces a range for an integer.
 def int_range(imin, imax):
     def int_type(value_str):
@@ -832,9 +1121,15 @@ def int_range(imin, imax):
         return value
     return int_type
 
-# Print a message to stdout. It's flushed.
+# Open and load (decode) an image. Loading also closes the file.
+def load_image(path):
+    image = PIL.Image.open(path)
+    image.load()
+    return image
+
+# Print a message to stdout. It's flushed and written all at once like warn().
 def message(msg):
-    print(msg)
+    sys.stdout.write(msg + "\n")
     sys.stdout.flush()
 
 # Open a WAD file and return a handle to it.
@@ -850,6 +1145,7 @@ def open_wad(context, path):
 # Parse the command line arguments.
 def parse_args():
     global args
+    global map_match
 
     parser = argparse.ArgumentParser(
         description="Convert maps in Doom WAD files to images.",
@@ -859,6 +1155,9 @@ def parse_args():
 
     parser.add_argument("-b", "--background-color", default="black",
         help="Background color. Names or #RRGGBB.")
+    parser.add_argument("--cache-dir", default="none",
+        help="Directory to cache scaled sprites in, such as \
+~/.cache/wad2image, or \"none\".")
     parser.add_argument("-a", "--circle-alpha", type=int_range(0, 255),
         default=255,
         help="The alpha (opacity) of circles. 0 (transparent) - 255 (opaque).")
@@ -912,6 +1211,8 @@ def parse_args():
         help="The height of the images created.")
     parser.add_argument("-i", "--iwad", default="*doom2.wad,*doom.wad,*doom1.wad",
         help="IWAD to load sprites from. Path or comma separated.")
+    parser.add_argument("--jobs", type=int_range(0, 1000), default=1,
+        help="Number of maps to draw in parallel. 0 for the number of CPUs.")
     parser.add_argument("-k", "--keep-identical-images", action="store_true",
         help="If the exact same image is created then keep both.")
     parser.add_argument("-l", "--line-colors",
@@ -934,6 +1235,11 @@ def parse_args():
         help="Directory to create output/image files.")
     parser.add_argument("--random-seed", type=int, default=0,
         help="Seed for random number generation.")
+    parser.add_argument("--require-simd", action="store_true",
+        help="Exit with an error if Pillow is not Pillow-SIMD.")
+    parser.add_argument("--resample", default="lanczos",
+        help="Filter used to scale sprites.",
+        choices=("bicubic", "bilinear", "lanczos", "nearest"))
     parser.add_argument("--rotation", type=float, default=0.0,
         help="Rotate image this amount clockwise in degrees.")
     parser.add_argument("--scale", type=float,
@@ -998,6 +1304,16 @@ def parse_args():
         args.height is None):
         args.width = 1024
 
+    # The sprite cache is only used if a directory other than "none" is given.
+    if args.cache_dir.lower() == "none":
+        args.cache_dir = None
+    else:
+        args.cache_dir = os.path.expanduser(expand_path(args.cache_dir))
+
+    # Compile the map pattern once rather than for each map. This matches
+    # the same as the case sensitive wildcards of omg's find().
+    map_match = re.compile(fnmatch.translate(args.map_pattern)).match
+
     return args
 
 # Parse the colors specified by --line-colors and --colors-color-list
@@ -1052,7 +1368,7 @@ def parse_colors():
 
     colors_names = str_split(args.colors_color_list, ",")
     for c in colors_names:
-        colors_values.append(PIL.ImageColor.getcolor(c, "RGB"))
+        colors_values.append(get_color(c, "RGB"))
 
 # Parse a comma separated list of key=value pairs.
 def parse_comma_sep(context, items_str):
@@ -1079,26 +1395,23 @@ def parse_conf(conf):
     conf_args = []
     try:
         verbose("Configuration path is \"%s\"." % config_path)
-        num = 0
         with open(config_path, "r") as fhand:
-            for line in fhand:
-                num += 1
-                line = line.strip()
-                if not line:
-                    continue
-                if line.startswith("#"):
-                    # Ignore comments
-                    continue
-                eq = line.find("=")
-                if eq == -1:
-                    fatal("Line %d of configuration file \"%s\" does not have \
-                        an \"=\"." % (num, config_path), file=sys.stderr)
-                key = line[:eq]
-                val = line[eq + 1:]
-                arg = "--" + key
-                conf_args.append(arg)
-                if val.lower() != "true":
-                    conf_args.append(val)
+            lines = fhand.read().splitlines()
+        for num, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                # Ignore comments
+                continue
+            key, eq, val = line.partition("=")
+            if not eq:
+                fatal("Line %d of configuration file \"%s\" does not have \
+an \"=\"." % (num, config_path))
+            arg = "--" + key
+            conf_args.append(arg)
+            if val.lower() != "true":
+                conf_args.append(val)
     except IOError as err:
         fatal("Could not open configuration \"%s\" for read: %s" % (
             config_path, err))
@@ -1148,17 +1461,22 @@ def parse_yadex():
     try:
         verbose("Yadex path is \"%s\"." % yadex_path)
         with open(yadex_path, "r") as fhand:
-            for line in fhand:
-                # We don't care about the description or comments.
-                line = re.sub("\".*\"", "desc", line)
-                line = re.sub("#.*", "", line)
-                tokens = line.split()
-                if len(tokens) != 7:
-                    continue
-                thing, tt, tg, flags, radius, desc, sprite = tokens # @UnusedVariable
-                if thing != "thing":
-                    continue
-                info[int(tt)] = (flags, int(radius), sprite)
+            lines = fhand.read().splitlines()
+        for line in lines:
+            # Most lines are not things, so skip those before the more
+            # expensive checks.
+            if "thing" not in line:
+                continue
+            # We don't care about the description or comments.
+            line = desc_re.sub("desc", line)
+            line = comment_re.sub("", line)
+            tokens = line.split()
+            if len(tokens) != 7:
+                continue
+            thing, tt, tg, flags, radius, desc, sprite = tokens # @UnusedVariable
+            if thing != "thing":
+                continue
+            info[int(tt)] = (flags, int(radius), sprite)
     except IOError as err:
         fatal("Cloud not open Yadex path \"%s\" for read: %s" % (yadex_path, err))
     tt_to_info = info
@@ -1167,6 +1485,64 @@ def parse_yadex():
 def path_join(path, bname):
     return os.path.normpath(os.path.join(path, bname))
 
+# Remove the least recently used sprites from the sprite cache until it's no
+# larger than cache_max_size. Temporary files left by interrupted writes count
+# toward the size, and are removed once they're older than cache_tmp_age.
+def prune_cache():
+    if not args.cache_dir or not os.path.isdir(args.cache_dir):
+        return
+
+    entries = []
+    total_size = 0
+    tmp_mtime_min = time.time() - cache_tmp_age
+    for bname in os.listdir(args.cache_dir):
+        is_tmp = bname.endswith(".tmp")
+        if not is_tmp and not bname.endswith(".png"):
+            continue
+        path = path_join(args.cache_dir, bname)
+        try:
+            st = os.stat(path)
+        except OSError:
+            # Possibly removed by another instance.
+            continue
+        if is_tmp and st.st_mtime < tmp_mtime_min:
+            # Newer ones may still be being written by another instance.
+            try:
+                os.remove(path)
+            except OSError as err:
+                warn("Unable to remove cached sprite \"%s\": %s" % (path, err))
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+        total_size += st.st_size
+
+    # Sprites are touched when they're read, so the oldest are the least
+    # recently used.
+    entries.sort()
+    for mtime, size, path in entries: # @UnusedVariable
+        if total_size <= cache_max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError as err:
+            warn("Unable to remove cached sprite \"%s\": %s" % (path, err))
+        total_size -= size
+
+# Read a scaled sprite from the sprite cache. None is returned if it's not
+# there.
+def read_sprite_cache(path):
+    if not path or not os.path.isfile(path):
+        return None
+
+    try:
+        image = load_image(path)
+
+        # Mark it as recently used for prune_cache().
+        os.utime(path, None)
+    except (IOError, OSError) as err:
+        warn("Unable to read cached sprite \"%s\": %s" % (path, err))
+        return None
+    return image
+
 # Read the link at a path, possibly recursively. If the path is not a link
 # that path is returned unchanged.
 def readlink(path, recur):
@@ -1193,30 +1569,77 @@ def remove_extra_images():
             if not diff_path in created_diffs:
                 # "path" is the base path without any index added.
                 for i in range(index):
-                    index_path = add_index(path, i)
-                    if os.path.isfile(index_path):
-                        remove_file(index_path)
-                if os.path.isfile(path):
-                    remove_file(path)
+                    remove_file(add_index(path, i))
+                remove_file(path)
 
-# Remove a path.
+# Remove a path. It's ok if it does not exist.
 def remove_file(path):
-    if os.path.isfile(path):
+    try:
         os.remove(path)
+    except FileNotFoundError:
+        pass
 
     if path in created_paths:
         created_paths.remove(path)
 
 # Rename that works on Linux and Windows even if the destination exists.
 def rename_file(old_path, new_path):
-    if os.path.isfile(new_path):
-        os.remove(new_path)
-    os.rename(old_path, new_path)
+    os.replace(old_path, new_path)
 
     if old_path in created_paths:
         created_paths.remove(old_path)
     created_paths.add(new_path)
 
+# Save the image data for a map to a path, or a path with an index added if
+# there are already images for the map.
+def save_map(name, path, image_data, im_hash):
+    if args.dup_images != "overwrite" and name in map_to_ipath:
+        index = map_to_ipath[name][0]
+        if im_hash and im_hash == map_to_hash[name]:
+            # Don't save this duplicate image. Also, don't store the index so
+            # it's as if it never happened.
+            verbose("Discarded map %s identical image \"%s\"" % (name,
+                add_index(path, index + 1)))
+            return
+        old_path = add_index(path, index)
+        if index == 1:
+            # The first file was created without an index, but now it needs
+            # one since there will be more than one file.
+            rename_file(path, old_path)
+            verbose("Renamed map %s image \"%s\" to \"%s\"." % (
+                name, path, old_path))
+        index += 1
+        new_path = add_index(path, index)
+    else:
+        # Either the first time, or overwrite (same file used for all
+        # duplicates of the the same map). Use the path without an index
+        # added.
+        index = 1
+        new_path = path
+    try:
+        with open(new_path, "wb") as fhand:
+            fhand.write(image_data)
+        created_paths.add(new_path)
+    except Exception as err:
+        fatal("Unable to save map %s to \"%s\": %s." % (name, new_path, err))
+
+    # Store the index to keep track of what was created.
+    verbose("Drew map %s to \"%s\"." % (name, new_path))
+    map_to_hash[name] = im_hash
+    map_to_ipath[name] = index, path
+
+# Scale the sprites for the thing types on a map that are not already scaled
+# with scale_jobs threads. The threads mostly run in parallel since Pillow
+# releases the GIL while resizing. The scaled sprites are stored by
+# get_thing_image() as usual.
+def scale_sprites(thing_types, scale):
+    needed = [thing_type for thing_type in set(thing_types)
+              if (thing_type, scale) not in tt_to_si]
+    if len(needed) < 2:
+        return
+    with concurrent.futures.ThreadPoolExecutor(scale_jobs) as executor:
+        list(executor.map(get_thing_image, needed, [scale] * len(needed)))
+
 # Show the images created, if requested.
 def show_images():
     if not args.show or not len(created_paths):
@@ -1252,22 +1675,78 @@ def show_images():
         fatal("Show command \"%s\" failed with an exception: %s" % (cmd, err))
 
 # Sort in place so that the shortest item is first, and then alphabetically
-# as a tie breaker.
+# as a tie breaker. Since sorting is stable sorting alphabetically and then by
+# length does both.
 def sort_shortest_first(items):
-    items.sort(key=lambda i: (len(i), i))
+    items.sort()
+    items.sort(key=len)
+
+# Convert a sprite (graphic lump) to an RGBA image. This is like omg's
+# Graphic.to_Image(), but each post (vertical run of pixels) is copied all at
+# once into a buffer of columns rather than pixel by pixel.
+def sprite_to_image(sprite):
+    data = sprite.data
+    data_len = len(data)
+    width, height = sprite.dimensions
+    tran_index = sprite.palette.tran_index
+
+    # Column x starts at x * height so that each post is contiguous.
+    columns = bytearray([tran_index]) * (width * height)
+    pointers = struct.unpack("<%dl" % width, data[8:8 + width * 4])
+    for x, pointer in enumerate(pointers):
+        if pointer >= data_len:
+            continue
+        start = x * height
+        y = -1
+        while data[pointer] != 0xff:
+            offset = data[pointer]
+            # For tall patches offsets are relative to the previous post.
+            y = y + offset if offset <= y else offset
+            post_length = data[pointer + 1]
+
+            # Posts are clipped to the column and to the data.
+            length = min(post_length, height - y, data_len - pointer - 3)
+            if length > 0:
+                columns[start + y:start + y + length] = \
+                    data[pointer + 3:pointer + 3 + length]
+            pointer += post_length + 4
+
+    # Graphic.to_raw() also makes index 0 transparent, so that's done here too
+    # for the sprites to look the same.
+    zero_table = bytearray([tran_index]) + bytearray(range(1, 256))
+    columns = columns.translate(zero_table)
+
+    transpose = getattr(PIL.Image, "Transpose", PIL.Image).TRANSPOSE
+    image = PIL.Image.frombytes("P", (height, width),
+                                bytes(columns)).transpose(transpose)
+
+    # Index 247 has special meaning to Doom engines. It's the transparent
+    # color. Rather than having Pillow check each pixel for it when converting
+    # to RGBA the palette has alpha, which is 0 only for it, so the alpha comes
+    # from the same lookup as the color. The color at this index in the
+    # palette is irrelevant. Note that this does not work with older Pillow
+    # (ver 2.2.1 at least). So the images will be solid squares in that case.
+    key = (sprite.palette.save_bytes, tran_index)
+    if key not in pal_to_rgba:
+        colors = sprite.palette.save_bytes
+        rgba = bytearray()
+        for i in range(256):
+            rgba += colors[i * 3:i * 3 + 3]
+            rgba.append(0 if i == tran_index else 255)
+        pal_to_rgba[key] = bytes(rgba)
+    image.putpalette(pal_to_rgba[key], "RGBA")
+    return image.convert("RGBA")
 
 # Split string str with delim. Also strip whitespace.
 def str_split(string, delim):
-    return [p.strip() for p in string.split(delim)]
+    return list(map(str.strip, string.split(delim)))
 
 # Convert a string to an integer ignoring non-digits and leading zeros.
 def str_to_num(string, default=None):
-    chars = [c for c in string if c.isdigit()]
     # Get rid of "0" prefix.
-    while len(chars) and chars[0] == "0":
-        chars.pop(0)
-    if chars:
-        return int("".join(chars))
+    digits = "".join(filter(str.isdigit, string)).lstrip("0")
+    if digits:
+        return int(digits)
     else:
         return default
 
@@ -1287,21 +1766,63 @@ def verbose(msg):
     if args.verbose:
         message(msg)
 
-# Print a warning to stderr. It's flushed.
+# Print a warning to stderr. It's flushed. It's written all at once so that
+# warnings from worker processes are not mixed together.
 def warn(msg):
-    print(msg, file=sys.stderr)
+    sys.stderr.write(msg + "\n")
     sys.stderr.flush()
 
+# Write a scaled sprite to the sprite cache, if there is one. It's written to a
+# temporary path first so that other instances, and other jobs, never read a
+# partially written file.
+def write_sprite_cache(path, image):
+    global cache_writable
+
+    if not path or not cache_writable:
+        return
+
+    # Thing types that share a sprite may be scaled to the same path at the
+    # same time by scale_sprites(), so the thread is part of the name.
+    tmp_path = "%s.%d.%d.tmp" % (path, os.getpid(),
+                                 threading.current_thread().ident)
+    cache_dir = os.path.dirname(path)
+    try:
+        if not os.path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another job may have just created it.
+                if not os.path.isdir(cache_dir):
+                    raise
+        image.save(tmp_path, "PNG")
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as err:
+        # Don't keep trying, and warning, for each sprite. Other threads may
+        # fail at the same time, so only the first one warns.
+        with cache_lock:
+            first_failure = cache_writable
+            cache_writable = False
+        if first_failure:
+            warn("Unable to write cached sprite \"%s\", so sprites will not \
+be cached: %s" % (path, err))
+        # The temporary file may not exist, or it may not be removable either.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
 # Main
 
 init()
 third_party()
 parse_args()
+check_pillow()
 parse_colors()
 parse_numbers()
 parse_yadex()
 find_open_iwad()
 draw_maps()
+prune_cache()
 create_diff_images()
 remove_extra_images()
 show_images()